@@ -1,9 +1,17 @@
-import os, json, duckdb
+import os, logging, threading, duckdb, orjson
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
+from sql_render_core import QueryJSONResponse, substitute_params, validate_params
 
 TEMPLATE_DIR = "./templates"
-app = FastAPI(title="SQL Renderer API")
+app = FastAPI(title="SQL Renderer API", default_response_class=QueryJSONResponse)
+logger = logging.getLogger(__name__)
+
+# Shared in-memory database; each request runs on its own cursor.
+_DUCKDB = duckdb.connect(database=":memory:")
+_DUCKDB.execute("SET enable_object_cache=true")  # reuse parquet metadata across queries
+_REGISTERED_VIEWS = {}
+_VIEWS_LOCK = threading.Lock()
 
 class QueryRequest(BaseModel):
     template_id: str
@@ -19,43 +27,34 @@ def render_sql(template_id: str):
 
     with open(sql_path, "r") as f:
         sql = f.read()
-    with open(meta_path, "r") as f:
-        meta = json.load(f)
+    with open(meta_path, "rb") as f:
+        meta = orjson.loads(f.read())
 
     return {"sql": sql, "meta": meta}
 
 
-def validate_params(meta: dict, params: dict):
-    required = meta.get("required_filters", [])
-    for r in required:
-        if r not in params:
-            raise ValueError(f"Missing required param: {r}")
-    return {**meta.get("defaults", {}), **params}
-
-
 def execute_sql(sql: str, meta: dict, params: dict):
-    con = duckdb.connect(database=":memory:")
-
-    # Register parquet files as views
+    # Register parquet files as views (once per path on the shared database)
     for view_name, parquet_path in meta.get("parquet_views", {}).items():
         abs_path = os.path.join(os.getcwd(), parquet_path)
+        if _REGISTERED_VIEWS.get(view_name) == abs_path:
+            continue
         if not os.path.exists(abs_path):
             raise FileNotFoundError(f"Parquet file {abs_path} not found")
-        con.execute(f"CREATE VIEW {view_name} AS SELECT * FROM '{abs_path}'")
+        with _VIEWS_LOCK:
+            _DUCKDB.execute(f"CREATE OR REPLACE VIEW {view_name} AS SELECT * FROM '{abs_path}'")
+            _REGISTERED_VIEWS[view_name] = abs_path
 
     # Substitute parameters safely
-    final_sql = sql
-    for key, value in params.items():
-        if isinstance(value, str):
-            value = value.replace("'", "''")
-            final_sql = final_sql.replace(f"@{key}", f"'{value}'")
-            print('here')
-        else:
-            final_sql = final_sql.replace(f"@{key}", str(value))
-    print(final_sql)  # Debugging line to see the final SQL
+    final_sql = substitute_params(sql, params)
+    logger.debug("final sql: %s", final_sql)
     # Execute and return results
-    df = con.execute(final_sql).fetchdf()
-    return df.to_dict(orient="records")
+    con = _DUCKDB.cursor()
+    try:
+        tbl = con.execute(final_sql).fetch_arrow_table()
+    finally:
+        con.close()
+    return tbl.to_pylist()
 
 
 @app.post("/query")
@@ -64,6 +63,6 @@ def run_query(request: QueryRequest):
         rendered = render_sql(request.template_id)
         final_params = validate_params(rendered["meta"], request.params)
         result = execute_sql(rendered["sql"], rendered["meta"], final_params)
-        return {"status": "ok", "data": result}
+        return QueryJSONResponse({"status": "ok", "data": result})
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -1,7 +1,8 @@
-import pandas as pd
+import duckdb
 
-# Load CSV
-df = pd.read_csv("Files/v_invoices_ledger.csv")
-
-# Save to Parquet (requires pyarrow or fastparquet installed)
-df.to_parquet("Parquet/v_invoices_ledger.parquet", engine="pyarrow", index=False)
+# Stream CSV -> Parquet inside DuckDB, so the file is never loaded into memory as a whole
+duckdb.execute("""
+COPY (SELECT * FROM read_csv_auto('Files/v_invoices_ledger.csv'))
+TO 'Parquet/v_invoices_ledger.parquet'
+(FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE 122880)
+""")
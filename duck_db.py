@@ -1,25 +1,39 @@
 import os
-import json
-import io
-import re
+import asyncio
+import hashlib
+import orjson
 import time
+import threading
+from contextlib import contextmanager
+from urllib.parse import quote, unquote
 import duckdb
-import pyarrow.parquet as pq
-import pandas as pd
-from fastapi import FastAPI, HTTPException, Request
+import pyarrow as pa
+from typing import Literal
+from fastapi import FastAPI, HTTPException, Request, Response
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from azure.storage.blob import BlobServiceClient
-from datetime import datetime
 import logging
 from opencensus.ext.azure.log_exporter import AzureLogHandler
+from sql_render_core import (
+    TEMPLATE_CACHE_TTL_SECONDS,
+    LRUCache,
+    LogRequestsMiddleware,
+    QueryJSONResponse,
+    bind_params,
+    iter_sql_words,
+    query_log_dimensions,
+    read_parquet_with_fallback,
+    render_sql,
+    validate_params,
+    validate_policy,
+)
 
 # -------------------------------
 # Setup
 # -------------------------------
 load_dotenv()
 
-app = FastAPI(title="SQL Renderer API")
+app = FastAPI(title="SQL Renderer API", default_response_class=QueryJSONResponse)
 
 logger = logging.getLogger()  # root logger
 logger.setLevel(logging.INFO)
@@ -28,227 +42,306 @@ connection_string = os.getenv("APPINSIGHTS_CONNECTION_STRING")
 if connection_string:
     logger.addHandler(AzureLogHandler(connection_string=connection_string))
 
+app.add_middleware(LogRequestsMiddleware)
+
 class QueryRequest(BaseModel):
     template_id: str
     params: dict
     template_dir: str           # where .sql.tmpl and .meta.json live
     parquet_dir: str            # base parquet directory (ADLS/local/http)
+    result_format: Literal["columns", "records"] = "columns"  # column names + row arrays, or one dict per row
+    no_cache: bool = False      # skip the response cache and run the query
 
 # -------------------------------
-# Middleware: Log API requests
+# DuckDB connection pool
 # -------------------------------
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    start_time = time.time()
-    response = await call_next(request)
-    duration_ms = int((time.time() - start_time) * 1000)
-
-    logger.info(
-        "HTTP request processed",
-        extra={
-            "custom_dimensions": {
-                "method": request.method,
-                "url": str(request.url),
-                "duration_ms": duration_ms,
-                "status_code": response.status_code,
-            }
-        },
-    )
-    return response
+# One in-memory database per parquet_dir, so view names from different parquet
+# directories never collide. Each entry is (connection, {view_name: abs_path}, reads_azure).
+_DUCKDB_POOL = LRUCache(maxsize=16)
+_DUCKDB_POOL_LOCK = threading.Lock()
+# Arrow tables downloaded through the Blob SDK fallback, keyed by blob path.
+_PARQUET_TABLES = LRUCache(maxsize=32, ttl=TEMPLATE_CACHE_TTL_SECONDS)
 
-# -------------------------------
-# Helpers
-# -------------------------------
-def download_parquet_blob(account_url, container_name, blob_name, credential):
-    try:
-        blob_service_client = BlobServiceClient(account_url=account_url, credential=credential)
-        blob_client = blob_service_client.get_blob_client(container=container_name, blob=blob_name)
-        stream = io.BytesIO()
-        blob_client.download_blob().readinto(stream)
-        stream.seek(0)
-        return stream
-    except Exception as e:
-        raise RuntimeError(f"Azure Blob download failed: {str(e)}")
 
+AZURE_READ_SETTINGS = {
+    "azure_read_transfer_concurrency": 16,
+    "azure_read_transfer_chunk_size": 8 * 1024 * 1024,
+    # Per-file read buffer: larger buffers mean fewer round trips on big parquet scans.
+    "azure_read_buffer_size": 128 * 1024 * 1024,
+}
 
-def read_file_with_fallback(path: str, account_name: str, account_key: str) -> str:
+
+def _load_azure_extension(con) -> bool:
+    """Let DuckDB range-read ADLS parquet itself; False means use the Blob SDK fallback."""
+    account_name = os.getenv("AZURE_STORAGE_ACCOUNT_NAME")
+    account_key = os.getenv("AZURE_STORAGE_ACCOUNT_KEY")
+    if not (account_name and account_key):
+        return False
     try:
-        blob_service_client = BlobServiceClient(
-            account_url=f"https://{account_name}.blob.core.windows.net",
-            credential=account_key
-        )
-        container = path.split("://")[1].split("@")[0]
-        blob_path = path.split(".net/")[1]
-        blob_client = blob_service_client.get_blob_client(container=container, blob=blob_path)
-        return blob_client.download_blob().content_as_text()
-    except Exception as sdk_err:
-        raise RuntimeError(f"Failed to read file from {path}: {sdk_err}")
+        try:
+            con.execute("LOAD azure;")
+        except duckdb.Error:
+            con.execute("INSTALL azure;")
+            con.execute("LOAD azure;")
+        connection_string = (
+            f"DefaultEndpointsProtocol=https;"
+            f"AccountName={account_name};"
+            f"AccountKey={account_key};"
+            f"EndpointSuffix=core.windows.net"
+        ).replace("'", "''")
+        con.execute(f"SET azure_storage_connection_string='{connection_string}';")
+    except duckdb.Error as e:
+        logger.warning("DuckDB azure extension unavailable, using Blob SDK fallback: %s", e)
+        return False
+    # Fewer, larger, parallel range reads per parquet file. A rejected setting only
+    # costs the tuning, not the extension itself.
+    for setting, value in AZURE_READ_SETTINGS.items():
+        try:
+            con.execute(f"SET {setting}={value}")
+        except duckdb.Error as e:
+            logger.warning("Could not set DuckDB %s: %s", setting, e)
+    return True
 
 
-def read_parquet_with_fallback(path: str, account_name: str, account_key: str):
+def _new_duckdb(parquet_dir: str):
+    con = duckdb.connect(database=":memory:")
+    # Keep parquet footers / remote file metadata between queries, so a view that is
+    # registered once is not re-read from storage on every request.
+    con.execute("SET enable_object_cache=true")
+    con.execute("SET enable_http_metadata_cache=true")
+    reads_azure = parquet_dir.startswith(("abfs://", "abfss://")) and _load_azure_extension(con)
+    return con, {}, reads_azure
+
+
+def _get_duckdb(parquet_dir: str):
+    entry = _DUCKDB_POOL.get(parquet_dir)
+    if entry is None:
+        with _DUCKDB_POOL_LOCK:
+            entry = _DUCKDB_POOL.get(parquet_dir)
+            if entry is None:
+                entry = _new_duckdb(parquet_dir)
+                _DUCKDB_POOL.set(parquet_dir, entry)
+    return entry
+
+
+def _duckdb_parquet_path(abs_path: str) -> str:
+    if not abs_path.startswith(("abfs://", "abfss://")):
+        return abs_path
+    # DuckDB's azure extension only speaks abfss:// and expects a URL-encoded blob path.
+    prefix, blob_path = abs_path.split(".net/", 1)
+    prefix = "abfss://" + prefix.split("://", 1)[1]
+    return f"{prefix}.net/{quote(unquote(blob_path))}"
+
+
+async def fetch_sdk_parquet_tables(parquet_dir: str, parquet_views: dict) -> dict:
+    """Arrow tables for the ADLS views parquet_dir's connection cannot read itself.
+
+    Cache misses are downloaded concurrently through the async Blob SDK.
+    """
+    _, _, reads_azure = await asyncio.to_thread(_get_duckdb, parquet_dir)
+    if reads_azure:
+        return {}
+
+    tables, missing = {}, {}
+    for view_name, parquet_file in parquet_views.items():
+        abs_path = os.path.join(parquet_dir, parquet_file)
+        if not abs_path.startswith(("abfs://", "abfss://")):
+            continue
+        table = _PARQUET_TABLES.get(abs_path)
+        if table is None:
+            missing[view_name] = abs_path
+        else:
+            tables[view_name] = table
+    if not missing:
+        return tables
+
+    account_name = os.getenv("AZURE_STORAGE_ACCOUNT_NAME")
+    account_key = os.getenv("AZURE_STORAGE_ACCOUNT_KEY")
+    downloaded = await asyncio.gather(
+        *(read_parquet_with_fallback(abs_path, account_name, account_key) for abs_path in missing.values())
+    )
+    for (view_name, abs_path), table in zip(missing.items(), downloaded):
+        _PARQUET_TABLES.set(abs_path, table)
+        tables[view_name] = table
+    return tables
+
+
+@contextmanager
+def duckdb_cursor(parquet_dir: str, parquet_views: dict, sdk_tables: dict = None):
+    """Check out a cursor on the shared database for parquet_dir with its views in place.
+
+    sdk_tables holds Arrow tables (from fetch_sdk_parquet_tables) for views the
+    connection cannot read itself.
+    """
+    sdk_tables = sdk_tables or {}
+    con, registered_views, _ = _get_duckdb(parquet_dir)
+    cur = con.cursor()
     try:
-        account_url = f"https://{account_name}.blob.core.windows.net"
-        container = path.split("://")[1].split("@")[0]
-        blob_path = path.split(".net/")[1]
-        stream = download_parquet_blob(account_url, container, blob_path, account_key)
-
-        table = pq.read_table(stream)
-        df = duckdb.from_arrow(table).df()
-        return df
-    except Exception as sdk_err:
-        raise RuntimeError(f"Failed to read parquet from {path}: {sdk_err}")
-
-
-def render_sql(template_id: str, template_dir: str):
-    sql_file = f"{template_id}.sql.tmpl"
-    meta_file = f"{template_id}.meta.json"
-    policy_file = "policy.json"
-
-    if template_dir.startswith(("abfs://", "abfss://")):
-        account_name = os.getenv("AZURE_STORAGE_ACCOUNT_NAME")
-        account_key = os.getenv("AZURE_STORAGE_ACCOUNT_KEY")
-        if not (account_name and account_key):
-            raise RuntimeError("Missing AZURE_STORAGE_ACCOUNT_NAME / AZURE_STORAGE_ACCOUNT_KEY")
-
-        sql_path = f"{template_dir}/{sql_file}"
-        meta_path = f"{template_dir}/{meta_file}"
-        policy_path = f"{template_dir}/{policy_file}"
-
-        sql = read_file_with_fallback(sql_path, account_name, account_key)
-        meta_text = read_file_with_fallback(meta_path, account_name, account_key)
-        policy_text = read_file_with_fallback(policy_path, account_name, account_key)
-
-        meta = json.loads(meta_text)
-        policy = json.loads(policy_text)
-
-        return {"sql_template": sql, "meta": meta, "policy": policy}
-    else:
-        sql_path = os.path.join(template_dir, sql_file)
-        meta_path = os.path.join(template_dir, meta_file)
-        policy_path = os.path.join(template_dir, policy_file)
-
-        if not os.path.exists(sql_path) or not os.path.exists(meta_path) or not os.path.exists(policy_path):
-            raise FileNotFoundError(f"Template {template_id} or policy.json not found in {template_dir}")
-
-        with open(sql_path, "r") as f:
-            sql = f.read()
-        with open(meta_path, "r") as f:
-            meta = json.load(f)
-        with open(policy_path, "r") as f:
-            policy = json.load(f)
-
-        return {"sql_template": sql, "meta": meta, "policy": policy}
+        for view_name, parquet_file in parquet_views.items():
+            abs_path = os.path.join(parquet_dir, parquet_file)
+            if view_name in sdk_tables:
+                continue
+            elif registered_views.get(view_name) != abs_path:
+                with _DUCKDB_POOL_LOCK:
+                    if registered_views.get(view_name) != abs_path:
+                        source = _duckdb_parquet_path(abs_path).replace("'", "''")
+                        con.execute(f"CREATE OR REPLACE VIEW {view_name} AS SELECT * FROM read_parquet('{source}')")
+                        registered_views[view_name] = abs_path
+
+        # Registered Arrow tables are connection-local, so bind them per cursor.
+        for view_name, table in sdk_tables.items():
+            cur.register(view_name, table)
+        yield cur
+    finally:
+        cur.close()
 
 # -------------------------------
-# Policy + Param Validation
+# Execute SQL with Telemetry
 # -------------------------------
-def validate_policy(params: dict, sql: str, policy: dict):
-    rules = policy.get("rules", {})
-
-    if "window_days" in params and rules.get("max_window_days"):
-        if params["window_days"] > rules["max_window_days"]:
-            raise ValueError(f"window_days exceeds policy max {rules['max_window_days']}")
-
-    if rules.get("disallow_future_as_of") and "as_of_date" in params:
-        today = datetime.utcnow().date()
-        as_of_date = normalize_date(params["as_of_date"])
-        if as_of_date > today:
-            raise ValueError("as_of_date cannot be in the future")
-
-    allowed_ops = [op.upper() for op in rules.get("allowed_actions", ["SELECT"])]
-    disallowed_ops = [a.upper() for a in rules.get("disallowed_patterns", [])]
-    sql_upper = sql.upper()
-    tokens = re.findall(r"[A-Z_]+", sql_upper)
-    first_token = tokens[0] if tokens else None
-    if first_token not in allowed_ops:
-        raise ValueError(f"SQL operation '{first_token}' not allowed. Allowed: {allowed_ops}")
-    for token in tokens:
-        if token in disallowed_ops:
-            raise ValueError(f"Disallowed SQL operation detected: {token}")
+def arrow_to_response(tbl, result_format: str = "columns") -> dict:
+    if result_format == "records":
+        return {"data": tbl.to_pylist()}
+    # Column names once, then one array per row: no per-row dict or repeated keys.
+    columns = [column.to_pylist() for column in tbl.columns]
+    return {"columns": tbl.column_names, "data": list(zip(*columns))}
 
-    return True
 
+def _postprocess(tbl: pa.Table, policy: dict):
+    """Apply the policy's post-fetch rules to the Arrow result; returns (table, truncated).
 
-def validate_params(meta: dict, params: dict):
-    required = meta.get("required_filters", [])
-    for r in required:
-        if r not in params:
-            raise ValueError(f"Missing required param: {r}")
-    return {**meta.get("defaults", {}), **params}
+    Works on Arrow columns rather than per-row Python objects, so further rules
+    can be expressed with pyarrow.compute.
+    """
+    row_limit = policy.get("rules", {}).get("row_limit")
+    truncated = bool(row_limit) and tbl.num_rows > row_limit
+    if truncated:
+        tbl = tbl.slice(0, row_limit)
+    return tbl, truncated
 
 
-def substitute_params(sql_template: str, params: dict):
-    sql = sql_template
-    for key, value in params.items():
-        if isinstance(value, str):
-            escaped = value.replace("'", "''")
-            sql = sql.replace(f"@{key}", f"'{escaped}'")
-        else:
-            sql = sql.replace(f"@{key}", str(value))
-    return sql
+_LIMIT_WORDS = frozenset({"LIMIT", "OFFSET", "FETCH"})
+
 
+def _limit_sql(sql: str, limit: int) -> str:
+    """Cap sql at limit rows, letting DuckDB stop early instead of slicing afterwards."""
+    sql = sql.rstrip().rstrip(";")
+    if _LIMIT_WORDS.isdisjoint(word.upper() for word in iter_sql_words(sql)):
+        # Appended to the outer query, so duplicate output columns keep their names (a
+        # subquery would rename "a", "a" to "a", "a_1"). The newline clears a trailing comment.
+        return f"{sql}\nLIMIT {limit}"
+    # The template already limits or pages somewhere; wrap it rather than add a second LIMIT.
+    return f"SELECT * FROM (\n{sql}\n) __q LIMIT {limit}"
 
-def normalize_date(d: str) -> str:
-    return datetime.strptime(d, "%Y-%m-%d").date()
+
+def execute_sql(sql_template: str, meta: dict, params: dict, parquet_dir: str, policy: dict,
+                sdk_tables: dict = None, result_format: str = "columns"):
+    # Values are bound by DuckDB, so the policy is checked against the SQL without them.
+    final_sql, args = bind_params(sql_template, params)
+    validate_policy(params, final_sql, policy)
+
+    row_limit = policy.get("rules", {}).get("row_limit")
+    if row_limit:
+        # The extra row tells truncation apart from an exact fit.
+        final_sql = _limit_sql(final_sql, int(row_limit) + 1)
+
+    with duckdb_cursor(parquet_dir, meta.get("parquet_views", {}), sdk_tables) as cur:
+        start_time = time.time()
+        tbl = cur.execute(final_sql, args).fetch_arrow_table()
+        duration_ms = int((time.time() - start_time) * 1000)
+
+    tbl, truncated = _postprocess(tbl, policy)
+
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(
+            "SQL executed",
+            extra={
+                "custom_dimensions": query_log_dimensions(
+                    final_sql, params,
+                    execution_time_ms=duration_ms,
+                    row_count=tbl.num_rows,
+                    truncated=truncated,
+                    # Sum of Arrow buffer sizes: O(columns), no per-cell walk.
+                    bytes_consumed=int(tbl.nbytes),
+                )
+            },
+        )
+
+    return arrow_to_response(tbl, result_format)
 
 # -------------------------------
-# Execute SQL with Telemetry
+# Response cache
 # -------------------------------
-def execute_sql(sql_template: str, meta: dict, params: dict, parquet_dir: str, policy: dict):
-    con = duckdb.connect(database=":memory:")
-    account_name = os.getenv("AZURE_STORAGE_ACCOUNT_NAME")
-    account_key = os.getenv("AZURE_STORAGE_ACCOUNT_KEY")
+# Serialized /query bodies, keyed by a hash of the request. Each entry is
+# (rendered, parquet_stamp, etag, body) and is only served while the template
+# has not been reloaded and the local parquet files are unchanged.
+_RESPONSE_CACHE = LRUCache(maxsize=1024)
 
-    for view_name, parquet_file in meta.get("parquet_views", {}).items():
-        abs_path = os.path.join(parquet_dir, parquet_file)
-        if abs_path.startswith(("abfs://", "abfss://")):
-            df = read_parquet_with_fallback(abs_path, account_name, account_key)
-            con.register(view_name, df)
-        else:
-            con.execute(f"CREATE VIEW {view_name} AS SELECT * FROM read_parquet('{abs_path}')")
 
-    final_sql = substitute_params(sql_template, params)
-    validate_policy(params, final_sql, policy)
+def _response_cache_key(request: QueryRequest, params: dict) -> str:
+    payload = orjson.dumps(
+        [request.template_id, request.template_dir, request.parquet_dir, params, request.result_format],
+        default=str, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS,
+    )
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
 
-    start_time = time.time()
-    df = con.execute(final_sql).fetchdf()
-    duration_ms = int((time.time() - start_time) * 1000)
 
-    row_limit = policy.get("rules", {}).get("row_limit")
-    if row_limit and len(df) > row_limit:
-        df = df.head(row_limit)
-
-    row_count = len(df)
-    bytes_consumed = df.memory_usage(deep=True).sum()
-
-    logger.info(
-        "SQL executed",
-        extra={
-            "custom_dimensions": {
-                "sql": final_sql[:1000],
-                "params": params,
-                "execution_time_ms": duration_ms,
-                "row_count": row_count,
-                "bytes_consumed": int(bytes_consumed),
-            }
-        },
-    )
+def _parquet_stamp(parquet_dir: str, parquet_views: dict):
+    """mtimes of the local parquet files behind parquet_views.
 
-    return df.to_dict(orient="records")
+    None for remote directories (and unreadable files); those responses are
+    cached for TEMPLATE_CACHE_TTL_SECONDS instead.
+    """
+    if "://" in parquet_dir:
+        return None
+    try:
+        return tuple(os.stat(os.path.join(parquet_dir, f)).st_mtime_ns for f in parquet_views.values())
+    except OSError:
+        return None
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
 
 # -------------------------------
 # API Endpoint
 # -------------------------------
 @app.post("/query")
-def run_query(request: QueryRequest):
+async def run_query(request: QueryRequest, http_request: Request):
     try:
-        rendered = render_sql(request.template_id, request.template_dir)
+        rendered = await render_sql(request.template_id, request.template_dir)
         final_params = validate_params(rendered["meta"], request.params)
-        result = execute_sql(
-            rendered["sql_template"], rendered["meta"], final_params,
-            request.parquet_dir, rendered["policy"]
-        )
-        return {"status": "ok", "data": result}
+        meta = rendered["meta"]
+        parquet_views = meta.get("parquet_views", {})
+
+        cache_key = _response_cache_key(request, final_params)
+        stamp = _parquet_stamp(request.parquet_dir, parquet_views)
+        cached = None if request.no_cache else _RESPONSE_CACHE.get(cache_key)
+        if cached is not None and cached[0] is rendered and cached[1] == stamp:
+            etag, body = cached[2], cached[3]
+        else:
+            sdk_tables = await fetch_sdk_parquet_tables(request.parquet_dir, parquet_views)
+            # DuckDB execution is CPU-bound and blocking, so keep it off the event loop.
+            result = await asyncio.to_thread(
+                execute_sql,
+                rendered["sql_template"], meta, final_params,
+                request.parquet_dir, rendered["policy"], sdk_tables, request.result_format,
+            )
+            body = QueryJSONResponse({"status": "ok", **result}).body
+            # Hash the body rather than the request, so a re-executed query that
+            # returns the same rows still revalidates as 304.
+            etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+            _RESPONSE_CACHE.set(
+                cache_key, (rendered, stamp, etag, body),
+                ttl=TEMPLATE_CACHE_TTL_SECONDS if stamp is None else None,
+            )
     except Exception as e:
         logger.error("Query failed", exc_info=True, extra={"custom_dimensions": {"error": str(e)}})
         raise HTTPException(status_code=400, detail=str(e))
+
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(http_request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
@@ -0,0 +1,617 @@
+"""Template loading, policy checks and parameter handling shared by the query services.
+
+duck_db (DuckDB over parquet), dynamic_dir (Synapse over ODBC) and the app.py
+prototype only differ in how they execute the rendered SQL; everything up to
+that point lives here.
+"""
+import os
+import io
+import asyncio
+import bisect
+import re
+import functools
+import time
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+import logging
+import aiohttp
+import orjson
+import pyarrow.parquet as pq
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.storage.blob.aio import BlobServiceClient
+from fastapi.responses import ORJSONResponse
+from starlette.datastructures import URL
+
+logger = logging.getLogger(__name__)
+
+# Include the SQL text and params in per-query telemetry (off by default: they are the
+# bulk of each log record and are rarely needed outside debugging).
+DETAILED_REQUEST_LOGGING = os.getenv("DETAILED_REQUEST_LOGGING") == "1"
+
+
+def query_log_dimensions(sql: str, params: dict, **dimensions) -> dict:
+    """custom_dimensions for a "SQL executed" record."""
+    if DETAILED_REQUEST_LOGGING:
+        dimensions["sql"] = sql[:1000]
+        dimensions["params"] = orjson.dumps(params, default=str).decode()
+    return dimensions
+
+# -------------------------------
+# JSON responses
+# -------------------------------
+def _json_default(obj):
+    # Same encodings jsonable_encoder used, so the wire format is unchanged.
+    if isinstance(obj, Decimal):
+        return int(obj) if obj.as_tuple().exponent >= 0 else float(obj)
+    if isinstance(obj, timedelta):
+        return obj.total_seconds()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+class QueryJSONResponse(ORJSONResponse):
+    """ORJSONResponse that also encodes the Decimal/timedelta cells SQL results carry.
+
+    Return it directly from a route: FastAPI then skips jsonable_encoder's per-cell walk,
+    and orjson handles datetime/date/UUID natively.
+    """
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(
+            content, default=_json_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        )
+
+# -------------------------------
+# Middleware: Log API requests
+# -------------------------------
+class LogRequestsMiddleware:
+    """Pure ASGI request logger: no extra task or Request/Response wrappers per call."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        status_code = None
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+        duration_ms = int((time.perf_counter() - start_time) * 1000)
+
+        logger.info(
+            "HTTP request processed",
+            extra={
+                "custom_dimensions": {
+                    "method": scope["method"],
+                    "url": str(URL(scope=scope)),
+                    "duration_ms": duration_ms,
+                    "status_code": status_code,
+                }
+            },
+        )
+
+# -------------------------------
+# In-process caches
+# -------------------------------
+# How long an ADLS template is trusted before its blob ETags are checked again.
+TEMPLATE_CACHE_TTL_SECONDS = float(os.getenv("TEMPLATE_CACHE_TTL_SECONDS", "60"))
+
+
+_DEFAULT_TTL = object()
+
+
+class LRUCache:
+    """Thread-safe LRU mapping with an optional per-entry TTL (seconds).
+
+    A ttl of None never expires; a ttl <= 0 disables the cache (set stores nothing).
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = _DEFAULT_TTL):
+        """Store value; ttl overrides the cache's own for this entry."""
+        if ttl is _DEFAULT_TTL:
+            ttl = self.ttl
+        if ttl is not None and ttl <= 0:
+            with self._lock:
+                self._data.pop(key, None)
+            return
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+_TEMPLATE_CACHE = LRUCache(maxsize=256)
+_BLOB_CLIENTS = {}
+# Keep-alive connections per account; concurrent requests beyond this wait for a free one.
+BLOB_CONNECTION_POOL_SIZE = int(os.getenv("BLOB_CONNECTION_POOL_SIZE", "16"))
+
+
+def get_blob_service_client(account_url: str, credential) -> BlobServiceClient:
+    # Building a client sets up a new HTTP pipeline (TLS + auth), so reuse one per account.
+    # Async clients hold an aiohttp session bound to the event loop that first used it.
+    key = (asyncio.get_running_loop(), account_url, credential)
+    client = _BLOB_CLIENTS.get(key)
+    if client is None:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=BLOB_CONNECTION_POOL_SIZE),
+            cookie_jar=aiohttp.DummyCookieJar(),
+            auto_decompress=False,
+            trust_env=True,
+        )
+        client = BlobServiceClient(
+            account_url=account_url,
+            credential=credential,
+            # Timeouts go on the transport: the client only applies its own to a transport it builds.
+            transport=AioHttpTransport(
+                session=session, session_owner=True, connection_timeout=5, read_timeout=30
+            ),
+            # Templates and most parquet files fit in one 4 MiB GET; larger blobs use 4 MiB ranges.
+            max_single_get_size=4 * 1024 * 1024,
+            max_chunk_get_size=4 * 1024 * 1024,
+        )
+        _BLOB_CLIENTS[key] = client
+    return client
+
+
+@functools.lru_cache(maxsize=512)
+def _get_blob_client(loop, account_url: str, credential, container: str, blob: str):
+    # loop is only part of the key, for the same reason as in get_blob_service_client.
+    return get_blob_service_client(account_url, credential).get_blob_client(container=container, blob=blob)
+
+
+def get_blob_client(account_url: str, credential, container: str, blob: str):
+    """Cached BlobClient; it shares its service client's pooled pipeline."""
+    return _get_blob_client(asyncio.get_running_loop(), account_url, credential, container, blob)
+
+# -------------------------------
+# Helpers
+# -------------------------------
+async def download_parquet_blob(account_url, container_name, blob_name, credential):
+    try:
+        blob_client = get_blob_client(account_url, credential, container_name, blob_name)
+        stream = io.BytesIO()
+        # Parquet files can span many 4 MiB chunks; fetch up to four of them at once.
+        downloader = await blob_client.download_blob(max_concurrency=4)
+        await downloader.readinto(stream)
+        stream.seek(0)
+        return stream
+    except Exception as e:
+        raise RuntimeError(f"Azure Blob download failed: {str(e)}")
+
+
+def _blob_client_for_path(path: str, account_name: str, account_key: str):
+    container = path.split("://")[1].split("@")[0]
+    blob_path = path.split(".net/")[1]
+    return get_blob_client(f"https://{account_name}.blob.core.windows.net", account_key, container, blob_path)
+
+
+async def read_file_with_etag(path: str, account_name: str, account_key: str):
+    """Return (etag, raw bytes) from a single download, so the ETag always matches the content."""
+    try:
+        downloader = await _blob_client_for_path(path, account_name, account_key).download_blob()
+        return downloader.properties.etag, await downloader.readall()
+    except Exception as sdk_err:
+        raise RuntimeError(f"Failed to read file from {path}: {sdk_err}")
+
+
+async def get_blob_etag(path: str, account_name: str, account_key: str) -> str:
+    try:
+        properties = await _blob_client_for_path(path, account_name, account_key).get_blob_properties()
+        return properties.etag
+    except Exception as sdk_err:
+        raise RuntimeError(f"Failed to read properties of {path}: {sdk_err}")
+
+
+async def read_parquet_with_fallback(path: str, account_name: str, account_key: str):
+    try:
+        account_url = f"https://{account_name}.blob.core.windows.net"
+        container = path.split("://")[1].split("@")[0]
+        blob_path = path.split(".net/")[1]
+        stream = await download_parquet_blob(account_url, container, blob_path, account_key)
+
+        return await asyncio.to_thread(pq.read_table, stream)
+    except Exception as sdk_err:
+        raise RuntimeError(f"Failed to read parquet from {path}: {sdk_err}")
+
+
+def _read_local_file(path: str, mode: str = "r"):
+    """Return (mtime_ns, contents) using the open file itself, with no separate exists/stat probe."""
+    with open(path, mode) as f:
+        return os.fstat(f.fileno()).st_mtime_ns, f.read()
+
+
+async def render_sql(template_id: str, template_dir: str):
+    """Load template, meta and policy, serving repeat requests from _TEMPLATE_CACHE.
+
+    Local entries are revalidated against the files' mtimes on every hit.
+    ADLS entries are trusted for TEMPLATE_CACHE_TTL_SECONDS, then revalidated
+    against the blobs' ETags, so an unchanged template is never downloaded twice.
+    """
+    sql_file = f"{template_id}.sql.tmpl"
+    meta_file = f"{template_id}.meta.json"
+    policy_file = "policy.json"
+    cache_key = (template_dir, template_id)
+
+    if template_dir.startswith(("abfs://", "abfss://")):
+        # ADLS entries are ((fresh_until, etags), rendered).
+        cached = _TEMPLATE_CACHE.get(cache_key)
+        if cached is not None and time.monotonic() < cached[0][0]:
+            return cached[1]
+
+        account_name = os.getenv("AZURE_STORAGE_ACCOUNT_NAME")
+        account_key = os.getenv("AZURE_STORAGE_ACCOUNT_KEY")
+        if not (account_name and account_key):
+            raise RuntimeError("Missing AZURE_STORAGE_ACCOUNT_NAME / AZURE_STORAGE_ACCOUNT_KEY")
+
+        sql_path = f"{template_dir}/{sql_file}"
+        meta_path = f"{template_dir}/{meta_file}"
+        policy_path = f"{template_dir}/{policy_file}"
+
+        paths = (sql_path, meta_path, policy_path)
+        # The three blobs are independent, so each step costs one round trip rather than three.
+        if cached is not None:
+            etags = tuple(await asyncio.gather(*(get_blob_etag(p, account_name, account_key) for p in paths)))
+            if etags == cached[0][1]:
+                _TEMPLATE_CACHE.set(cache_key, ((time.monotonic() + TEMPLATE_CACHE_TTL_SECONDS, etags), cached[1]))
+                return cached[1]
+
+        (sql_etag, sql_bytes), (meta_etag, meta_text), (policy_etag, policy_text) = await asyncio.gather(
+            *(read_file_with_etag(p, account_name, account_key) for p in paths)
+        )
+        etags = (sql_etag, meta_etag, policy_etag)
+        sql = sql_bytes.decode("utf-8")
+
+        meta = orjson.loads(meta_text)
+        policy = orjson.loads(policy_text)
+        compile_policy(policy)
+
+        rendered = {"sql_template": sql, "meta": meta, "policy": policy}
+        _TEMPLATE_CACHE.set(cache_key, ((time.monotonic() + TEMPLATE_CACHE_TTL_SECONDS, etags), rendered))
+        return rendered
+    else:
+        sql_path = os.path.join(template_dir, sql_file)
+        meta_path = os.path.join(template_dir, meta_file)
+        policy_path = os.path.join(template_dir, policy_file)
+
+        cached = _TEMPLATE_CACHE.get(cache_key)
+        try:
+            if cached is not None:
+                stamp = tuple(os.stat(p).st_mtime_ns for p in (sql_path, meta_path, policy_path))
+                if stamp == cached[0]:
+                    return cached[1]
+
+            sql_mtime, sql = _read_local_file(sql_path)
+            # JSON is parsed straight from bytes, skipping the text decode.
+            meta_mtime, meta_text = _read_local_file(meta_path, "rb")
+            policy_mtime, policy_text = _read_local_file(policy_path, "rb")
+        except FileNotFoundError as e:
+            raise FileNotFoundError(
+                f"Template {template_id} or policy.json not found in {template_dir}: {e.filename}"
+            ) from None
+        stamp = (sql_mtime, meta_mtime, policy_mtime)
+
+        meta = orjson.loads(meta_text)
+        policy = orjson.loads(policy_text)
+        compile_policy(policy)
+
+        rendered = {"sql_template": sql, "meta": meta, "policy": policy}
+        _TEMPLATE_CACHE.set(cache_key, (stamp, rendered))
+        return rendered
+
+# -------------------------------
+# Policy + Param Validation
+# -------------------------------
+# One scanner for the whole SQL: string literals, quoted identifiers and comments are
+# consumed whole (and ignored), so only words in group 2 reach the policy checks.
+# Unterminated strings and comments run to the end of the input, which the database
+# rejects anyway. Group 1 catches what DuckDB and T-SQL lex differently (E'' strings,
+# $$ strings, nested comments, and [ ] holding anything DuckDB's list literal could lex
+# as a string, comment or nested list: quotes, $, ;, [, "--", "/*"); from there on the scanner
+# cannot tell a quote from a string opener, so the rest is scanned as plain words.
+_SQL_SCAN_RE = re.compile(
+    r"'[^']*(?:''[^']*)*'?"
+    r'|"[^"]*(?:""[^"]*)*"?'
+    r"|\[(?:[^\]\['\";$/-]|-(?!-)|/(?!\*))*\]"
+    r"|--[^\n]*"
+    r"|/\*(?:(?!/\*).)*?(?:\*/|\Z)"
+    r"|([Ee]'|\[|/\*|\$(?:[A-Za-z_][A-Za-z0-9_]*)?\$)"
+    r"|([A-Za-z_]+)",
+    re.DOTALL,
+)
+_SQL_WORD_RE = re.compile(r"[A-Za-z_]+")
+
+
+def iter_sql_words(sql: str):
+    """Yield the words of sql as written, skipping string literals, quoted identifiers and comments."""
+    for match in _SQL_SCAN_RE.finditer(sql):
+        if match.group(1) is not None:
+            yield from _SQL_WORD_RE.findall(sql, match.start())
+            return
+        word = match.group(2)
+        if word is not None:
+            yield word
+
+
+def compile_policy(policy: dict) -> dict:
+    """Precompute the op lookups validate_policy needs; cached on the policy dict."""
+    rules = policy.get("rules", {})
+    allowed_ops = [op.upper() for op in rules.get("allowed_actions", ["SELECT"])]
+    disallowed_ops = [a.upper() for a in rules.get("disallowed_patterns", [])]
+    disallowed_set = frozenset(disallowed_ops)
+    # An op that is also disallowed can never start a query, so once the first
+    # token passes allowed_set only the remaining tokens need the disallowed scan.
+    allowed_ops = [op for op in allowed_ops if op not in disallowed_set]
+    compiled = {
+        "allowed_ops": allowed_ops,
+        "allowed_set": frozenset(allowed_ops),
+        "disallowed_set": disallowed_set,
+        "disallowed_max_len": max(map(len, disallowed_set), default=0),
+    }
+    policy["_compiled"] = compiled
+    return compiled
+
+
+def validate_policy(params: dict, sql: str, policy: dict):
+    rules = policy.get("rules", {})
+
+    if "window_days" in params and rules.get("max_window_days"):
+        if params["window_days"] > rules["max_window_days"]:
+            raise ValueError(f"window_days exceeds policy max {rules['max_window_days']}")
+
+    if rules.get("disallow_future_as_of") and "as_of_date" in params:
+        today = datetime.now(timezone.utc).date()
+        as_of_date = normalize_date(params["as_of_date"])
+        if as_of_date > today:
+            raise ValueError("as_of_date cannot be in the future")
+
+    compiled = policy.get("_compiled") or compile_policy(policy)
+    tokens = iter_sql_words(sql)
+    first_token = next(tokens, None)
+    if first_token is not None:
+        first_token = first_token.upper()
+    if first_token not in compiled["allowed_set"]:
+        raise ValueError(f"SQL operation '{first_token}' not allowed. Allowed: {compiled['allowed_ops']}")
+    disallowed_set = compiled["disallowed_set"]
+    if disallowed_set:
+        # Words longer than every disallowed op cannot match, so they are never uppercased.
+        max_len = compiled["disallowed_max_len"]
+        for token in tokens:
+            if len(token) <= max_len and token.upper() in disallowed_set:
+                raise ValueError(f"Disallowed SQL operation detected: {token.upper()}")
+
+    return True
+
+
+_FMT_SPLIT_RE = re.compile(r"[,|]")
+_DECIMAL_RE = re.compile(r"^-?\d+(\.\d+)?$")
+# fromisoformat alone would also accept other ISO 8601 forms, such as 20250105.
+_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+# Per-format checks: each returns (valid, value to bind), coercing numeric and date strings.
+def _is_strict_integer(val):
+    # strict integer: must be int type
+    return isinstance(val, int), val
+
+
+def _is_integer(val):
+    # integer: allow numeric string
+    if isinstance(val, int):
+        return True, val
+    if isinstance(val, str) and val.isdigit():
+        return True, int(val)
+    return False, val
+
+
+def _is_decimal(val):
+    # decimal: allow int, float, or numeric string
+    if isinstance(val, (int, float)):
+        return True, val
+    if isinstance(val, str) and _DECIMAL_RE.match(val):
+        return True, float(val)
+    return False, val
+
+
+def _is_date(val):
+    # date: enforce YYYY-MM-DD
+    # Bound as a date: DuckDB will not compare a VARCHAR parameter with a DATE/TIMESTAMP column.
+    if isinstance(val, str) and _DATE_RE.match(val):
+        return True, date.fromisoformat(val)
+    return False, val
+
+
+def _is_string(val):
+    return isinstance(val, str), val
+
+
+def _format_check(fmt_lower: str):
+    if "integer" in fmt_lower and "strict" in fmt_lower:
+        return _is_strict_integer
+    if "integer" in fmt_lower:
+        return _is_integer
+    if "decimal" in fmt_lower:
+        return _is_decimal
+    if "date" in fmt_lower:
+        return _is_date
+    if "string" in fmt_lower:
+        return _is_string
+    return None
+
+
+def _build_validator(fmt_list: list):
+    """Return a validator(val) -> (valid, value) trying fmt_list's formats in order."""
+    checks = [check for check in map(_format_check, fmt_list) if check is not None]
+
+    def validate(val):
+        for check in checks:
+            try:
+                valid, value = check(val)
+            except Exception:
+                continue
+            if valid:
+                return True, value
+        return False, val
+
+    return validate
+
+
+def _param_validators(meta: dict) -> dict:
+    """{param: (validator, fmt_list)} compiled from meta's param_formats; cached on the meta dict."""
+    validators = meta.get("_param_validators")
+    if validators is None:
+        validators = {}
+        for key, fmt in meta.get("param_formats", {}).items():
+            fmt_list = [f.strip().lower() for f in _FMT_SPLIT_RE.split(fmt)]  # support "decimal,integer"
+            validators[key] = (_build_validator(fmt_list), fmt_list)
+        meta["_param_validators"] = validators
+    return validators
+
+
+def validate_params(meta: dict, params: dict):
+    required = meta.get("required_filters", [])
+    defaults = meta.get("defaults", {})
+
+    # 1️⃣ Check required parameters
+    for r in required:
+        if r not in params:
+            raise ValueError(f"Missing required param: {r}")
+
+    # 2️⃣ Merge defaults
+    merged_params = {**defaults, **params}
+
+    # 3️⃣ Type validation based on param_formats
+    for key, (validate, fmt_list) in _param_validators(meta).items():
+        if key not in merged_params:
+            continue
+
+        val = merged_params[key]
+        valid, merged_params[key] = validate(val)
+        if not valid:
+            allowed = ", ".join(fmt_list)
+            raise ValueError(f"Param '{key}' invalid type: expected one of ({allowed}), got {type(val).__name__}")
+
+    return merged_params
+
+
+@functools.lru_cache(maxsize=256)
+def _param_pattern(names: frozenset):
+    # Longest names first, so "@foo_bar" is never consumed as "@foo" + "_bar". Names
+    # may still be spliced into identifiers (e.g. "liability_@window_daysd_ago").
+    alternation = "|".join(re.escape(n) for n in sorted(names, key=len, reverse=True))
+    return re.compile(f"@({alternation})")
+
+
+def _sql_literal(value) -> str:
+    if isinstance(value, str):
+        # Most values carry no quote at all; skip the escape pass for them.
+        return "'" + (value.replace("'", "''") if "'" in value else value) + "'"
+    if value is None:
+        return "NULL"
+    if isinstance(value, date):
+        return f"'{value.isoformat()}'"
+    return str(value)
+
+
+# Spans where an @name is text rather than a value: string literals, quoted identifiers, comments.
+_SQL_TEXT_RE = re.compile(
+    r"'[^']*(?:''[^']*)*'?"
+    r'|"[^"]*(?:""[^"]*)*"?'
+    r"|--[^\n]*"
+    r"|/\*.*?(?:\*/|\Z)",
+    re.DOTALL,
+)
+# T-SQL only takes an unparenthesized TOP with an integer constant: TOP @n must bind as TOP (?).
+_TOP_TAIL_RE = re.compile(r"(?:^|[^A-Za-z0-9_])TOP\s*$", re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_placeholders(sql_template: str, names: frozenset, style: str = "numeric"):
+    """Rewrite @name references to placeholders, once per template, name set and style.
+
+    "numeric" gives DuckDB's $n, one number per name; "qmark" gives ODBC's ?, one
+    per occurrence. Returns (sql, ordered_names, spliced_names). References spliced
+    into an identifier, or written inside a literal or comment (e.g. INTERVAL '@n DAYS'),
+    cannot be bound, so they are left as @name for substitute_params.
+    """
+    positions, occurrences, spliced = {}, [], set()
+    text_spans = [m.span() for m in _SQL_TEXT_RE.finditer(sql_template)] if names else []
+    text_starts = [start for start, _ in text_spans]
+
+    def in_text(i):
+        k = bisect.bisect_right(text_starts, i) - 1
+        return k >= 0 and i < text_spans[k][1]
+
+    def is_word(i):
+        return 0 <= i < len(sql_template) and (sql_template[i].isalnum() or sql_template[i] == "_")
+
+    def repl(m):
+        name = m.group(1)
+        if is_word(m.start() - 1) or is_word(m.end()) or in_text(m.start()):
+            spliced.add(name)
+            return m.group(0)
+        if style == "qmark":
+            occurrences.append(name)
+            placeholder = "?"
+        else:
+            placeholder = f"${positions.setdefault(name, len(positions) + 1)}"
+        if _TOP_TAIL_RE.search(sql_template, max(0, m.start() - 32), m.start()):
+            return f"({placeholder})"
+        return placeholder
+
+    sql = _param_pattern(names).sub(repl, sql_template) if names else sql_template
+    order = tuple(occurrences) if style == "qmark" else tuple(positions)
+    return sql, order, frozenset(spliced)
+
+
+def bind_params(sql_template: str, params: dict, style: str = "numeric"):
+    """Return (sql, args) for execute, binding every param the driver can take as a value.
+
+    style is "numeric" ($n, DuckDB) or "qmark" (?, pyodbc).
+    """
+    sql, order, spliced = _compile_placeholders(sql_template, frozenset(params), style)
+    if spliced:
+        sql = substitute_params(sql, {name: params[name] for name in spliced})
+    return sql, [params[name] for name in order]
+
+
+def substitute_params(sql_template: str, params: dict):
+    """Replace every @name with its SQL literal in a single pass over the template."""
+    if not params:
+        return sql_template
+    # Format each value once up front, however often the template references it.
+    literals = {key: _sql_literal(value) for key, value in params.items()}
+    return _param_pattern(frozenset(literals)).sub(lambda m: literals[m.group(1)], sql_template)
+
+
+def normalize_date(d) -> date:
+    return d if isinstance(d, date) else date.fromisoformat(d)
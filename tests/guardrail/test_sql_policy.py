@@ -0,0 +1,38 @@
+import pytest
+
+from sql_render_core import validate_policy
+
+POLICY = {"rules": {"allowed_actions": ["SELECT", "WITH"], "disallowed_patterns": ["DROP", "DELETE"]}}
+
+# Each of these hides a DROP from a scanner that treats the stray quote as a string opener.
+SMUGGLED_DROP = [
+    "SELECT \"a'b\" FROM t; DROP TABLE t; --'",
+    "SELECT [a'b] FROM t; DROP TABLE t; --'",
+    "SELECT ['a]', 1] AS x; DROP TABLE t; --'",
+    "SELECT [1 -- ] '\n] AS x; DROP VIEW inv; SELECT 1 AS y --'",
+    "SELECT [1 /* ] ' */] AS x; DROP TABLE t; --'",
+    "SELECT [$$ ] '\n$$] AS x; DROP TABLE t; --'",
+    "SELECT [[1], ' ] '] AS x; DROP TABLE t; --'",
+    "SELECT $$it's$$ AS x; DROP TABLE t; --'",
+    "SELECT $q$it's$q$ AS x; DROP TABLE t; --'",
+    "SELECT E'\\'' AS x; DROP TABLE t; --'",
+    "SELECT 1 /* /* */ 'x */; DROP TABLE t; --'",
+]
+
+ALLOWED = [
+    "SELECT 'drop the ''DROP''' AS note FROM t",
+    "SELECT \"DROP\", [delete] FROM t -- DROP\n",
+    "WITH x AS (SELECT 1 /* DELETE */) SELECT * FROM x",
+    "SELECT [1, 2] AS xs, [a-b] AS d, $1 AS tenant FROM t",
+]
+
+
+@pytest.mark.parametrize("sql", SMUGGLED_DROP)
+def test_stray_quotes_do_not_hide_disallowed_ops(sql):
+    with pytest.raises(ValueError, match="Disallowed SQL operation detected: DROP"):
+        validate_policy({}, sql, POLICY)
+
+
+@pytest.mark.parametrize("sql", ALLOWED)
+def test_quoted_words_are_not_ops(sql):
+    assert validate_policy({}, sql, POLICY)